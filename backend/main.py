@@ -1,7 +1,8 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+import orjson
 from contextlib import asynccontextmanager
 from mcp_client import MCPClient
 from dotenv import load_dotenv
@@ -41,16 +42,39 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     query: str
 
-@app.post("/query")
-async def process_query(request: QueryRequest) -> Dict[str, List[Dict[str, Any]]]:
+@app.api_route("/health", methods=["GET", "HEAD"])
+async def health() -> dict:
+    """Liveness check; also lets clients open a pooled connection before the first query."""
+    return {"status": "ok"}
+
+@app.post("/query", response_class=ORJSONResponse, response_model=None)
+async def process_query(request: QueryRequest) -> ORJSONResponse:
     """Processes a query through the MCP agent and returns the conversation history."""
     client: MCPClient = app.state.client
     try:
+        # The messages are already plain JSON-ready dicts, so they are rendered
+        # directly by orjson without FastAPI's response validation and encoding.
         messages = await client.process_query(request.query)
-        return {"messages": messages}
+        return ORJSONResponse(content={"messages": messages})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/query/stream", response_class=StreamingResponse)
+async def stream_query(request: QueryRequest) -> StreamingResponse:
+    """Processes a query through the MCP agent, streaming each message as NDJSON as soon as it is produced."""
+    client: MCPClient = app.state.client
+
+    async def ndjson_messages():
+        try:
+            async for message in client.stream_query(request.query):
+                yield orjson.dumps(message) + b"\n"
+        except Exception as e:
+            # Headers are already sent, so errors are reported as a final NDJSON line
+            yield orjson.dumps({"error": str(e)}) + b"\n"
+
+    return StreamingResponse(ndjson_messages(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Match the frontend's 75s keep-alive so idle pooled connections are not dropped after uvicorn's 5s default
+    uvicorn.run(app, host="0.0.0.0", port=8000, timeout_keep_alive=75)
\ No newline at end of file
@@ -1,21 +1,27 @@
 import asyncio
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator
 from contextlib import AsyncExitStack
 import traceback
-import json
 import os
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
 from anthropic import Anthropic, AsyncAnthropic
 from anthropic.types import Message
 
+AGENT_SYSTEM_PROMPT = (
+    "You answer questions about an electric vehicle database using the available tools. "
+    "Start with plan_and_generate_sql, which extracts entities and writes a validated SQL query in one step. "
+    "Only fall back to ner_generator_dynamic, create_sql and validator_sql_agent if it returns an error. "
+    "Then run the query with run_sqlite_query (using handle_error_agent if it fails) "
+    "and finish with generate_final_answer."
+)
+
 class MCPClient:
     def __init__(self):
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
         self.llm = AsyncAnthropic()
         self.tools: List[Dict[str, Any]] = []
-        self.messages: List[Dict[str, Any]] = []
 
     async def connect_to_server(self, server_script_path: str):
         try:
@@ -48,78 +54,81 @@ class MCPClient:
             raise
 
     async def process_query(self, query: str) -> List[Dict[str, Any]]:
-        self.messages = [{"role": "user", "content": query}]
+        return [message async for message in self.stream_query(query)]
 
-        while True:
-            print(f"Calling LLM with {len(self.messages)} messages...")
-            response: Message = await self.llm.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=4096,
-                messages=self.messages,
-                tools=self.tools,
-            )
+    async def stream_query(self, query: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Runs the agent loop for a query, yielding each serialized message as soon as it is added.
+        The conversation is local to the call, so concurrent queries can share one client.
+        """
+        messages: List[Dict[str, Any]] = [{"role": "user", "content": query}]
+        yield messages[-1]
 
-            response_message = response.content
-            has_tool_call = any(block.type == "tool_use" for block in response_message)
+        while True:
+            print(f"Calling LLM with {len(messages)} messages...")
+            # Stream the response so each tool call starts as soon as its tool_use block
+            # is complete, overlapping tool execution with the rest of the generation.
+            tool_tasks: List[asyncio.Task] = []
+            try:
+                async with self.llm.messages.stream(
+                    model="claude-3-5-sonnet-20241022",
+                    max_tokens=4096,
+                    system=AGENT_SYSTEM_PROMPT,
+                    messages=messages,
+                    tools=self.tools,
+                ) as stream:
+                    async for event in stream:
+                        if event.type == "content_block_stop" and event.content_block.type == "tool_use":
+                            tool_tasks.append(asyncio.create_task(self._run_tool(event.content_block)))
+                    response: Message = await stream.get_final_message()
+            except BaseException:
+                for task in tool_tasks:
+                    task.cancel()
+                raise
 
-            self.messages.append(
+            messages.append(
                 {"role": "assistant", "content": response.content}
             )
+            yield {"role": "assistant", "content": response.model_dump(mode="json", exclude_none=True)["content"]}
 
-            if not has_tool_call:
+            if not tool_tasks:
                 print("LLM responded with final answer.")
-                break
+                return
 
             print("LLM requested tool calls.")
-            tool_results = []
-            for content_block in response_message:
-                if content_block.type == "tool_use":
-                    tool_name = content_block.name
-                    tool_input = content_block.input
-                    tool_use_id = content_block.id
+            # gather keeps the results in the same order as the tool_use blocks.
+            tool_results = await asyncio.gather(*tool_tasks)
 
-                    print(f"Executing tool: {tool_name} with args: {tool_input}")
-                    try:
-                        # The tools in your server.py return JSON strings, so we parse them.
-                        # The tool call itself expects a dictionary.
-                        tool_input_parsed = {k: json.loads(v) if isinstance(v, str) and v.startswith('{') else v for k, v in tool_input.items()}
-                        result = await self.session.call_tool(tool_name, tool_input_parsed)
-                        
-                        tool_results.append(
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": tool_use_id,
-                                "content": result.content,
-                            }
-                        )
-                    except Exception as e:
-                        print(f"Error calling tool {tool_name}: {e}")
-                        tool_results.append(
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": tool_use_id,
-                                "content": [{"type": "text", "text": f"Error executing tool: {e}"}],
-                                "is_error": True,
-                            }
-                        )
-            
-            self.messages.append({"role": "user", "content": tool_results})
+            # tool_result blocks are already plain dicts, so the same message is sent and yielded
+            tool_message = {"role": "user", "content": tool_results}
+            messages.append(tool_message)
+            yield tool_message
 
-        # Convert the complex message objects to a serializable format for the API response
-        serializable_messages = []
-        for msg in self.messages:
-            if isinstance(msg['content'], list):
-                content_list = []
-                for item in msg['content']:
-                    if hasattr(item, 'dict'):
-                        content_list.append(item.dict())
-                    else:
-                        content_list.append(item)
-                serializable_messages.append({'role': msg['role'], 'content': content_list})
-            else:
-                serializable_messages.append(msg)
-        
-        return serializable_messages
+    async def _run_tool(self, content_block) -> Dict[str, Any]:
+        """Executes a single tool_use block and returns its tool_result message."""
+        tool_name = content_block.name
+        tool_input = content_block.input
+        tool_use_id = content_block.id
+
+        print(f"Executing tool: {tool_name} with args: {tool_input}")
+        try:
+            # Tool inputs are passed through as-is; FastMCP already decodes JSON-encoded
+            # arguments for dict parameters on the server side.
+            result = await self.session.call_tool(tool_name, tool_input)
+
+            return {
+                "type": "tool_result",
+                "tool_use_id": tool_use_id,
+                "content": [item.model_dump(mode="json", exclude_none=True) for item in result.content],
+            }
+        except Exception as e:
+            print(f"Error calling tool {tool_name}: {e}")
+            return {
+                "type": "tool_result",
+                "tool_use_id": tool_use_id,
+                "content": [{"type": "text", "text": f"Error executing tool: {e}"}],
+                "is_error": True,
+            }
 
     async def cleanup(self):
         print("Cleaning up resources...")
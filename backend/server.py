@@ -1,11 +1,16 @@
+import io
+import asyncio
 import os
-import json
+import csv
+import orjson
 import sqlite3
+import functools
+import threading
+from collections import defaultdict
 from mcp.server.fastmcp import FastMCP
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 from dotenv import load_dotenv
-import pandas as pd
-from typing import Dict
+from typing import Dict, List
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,8 +21,17 @@ mcp = FastMCP(
 )
 
 # Initialize the Anthropic client
-anthropic_client = Anthropic(
-    api_key=os.getenv("ANTHROPIC_API_KEY"),)
+# The SDK retries rate-limit (429) and overload errors with jittered exponential backoff,
+# honouring the retry-after header; the semaphore caps how many calls are in flight at once.
+anthropic_client = AsyncAnthropic(
+    api_key=os.getenv("ANTHROPIC_API_KEY"),
+    max_retries=int(os.getenv("ANTHROPIC_MAX_RETRIES", "3")),)
+_ANTHROPIC_SEM = asyncio.Semaphore(int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "8")))
+
+async def _create_message(**kwargs):
+    """Calls messages.create while holding a slot of the Anthropic concurrency limit."""
+    async with _ANTHROPIC_SEM:
+        return await anthropic_client.messages.create(**kwargs)
 
 # --- Absolute Paths for Data Files ---
 # This ensures the server can find the files regardless of how it's started.
@@ -25,135 +39,193 @@ BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(BASE_DIR, "data", "electric_vehicle_data.db")
 DATA_DICT_PATH = os.path.join(BASE_DIR, "data", "data_dictionary.csv")
 
+# --- Shared Database Connection ---
+# A single connection is reused for the lifetime of the server instead of
+# connecting per query. The lock serialises access in case tools run on a threadpool.
+# The tools run LLM-generated SQL, so the database is opened read-only and cannot be modified.
+_DB_CONN = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False)
+_DB_CONN.execute("PRAGMA query_only=ON")
+_DB_CONN.execute("PRAGMA cache_size=-20000")
+_DB_LOCK = threading.Lock()
+
 # --- Helper Function ---
+@functools.lru_cache(maxsize=1)
 def get_data_dictionary_description():
     """
     Reads the data dictionary CSV and formats it into a string, grouped by table,
     to provide clear context to the AI about the entire database schema.
     """
     try:
-        df = pd.read_csv(DATA_DICT_PATH)
-       
-        # Check if the required 'Table Name' column exists
-        if 'Table Name' not in df.columns:
-            return "Error: The data dictionary CSV is missing the required 'Table Name' column."
-
-        description = "This is the data dictionary. It explains the columns for multiple tables in the database:\n"
-       
-        # Group the dataframe by the 'Table Name'
-        for table_name, group in df.groupby('Table Name'):
-            description += f"\n--- Table: {table_name} ---\n"
-            # Iterate over each row in the group (i.e., each column for the current table)
-            for _, row in group.iterrows():
-                description += f"- Column '{row['Column Header']}' (also called '{row['Business Header']}'): {row['Definition']}. Example: {row['Example']}\n"
-       
-        return description
+        with open(DATA_DICT_PATH, newline="") as f:
+            reader = csv.DictReader(f)
+
+            # Check if the required 'Table Name' column exists
+            if 'Table Name' not in (reader.fieldnames or []):
+                return "Error: The data dictionary CSV is missing the required 'Table Name' column."
+
+            # Group the column descriptions by 'Table Name' in a single pass
+            tables = defaultdict(list)
+            for row in reader:
+                tables[row['Table Name']].append(
+                    f"- Column '{row['Column Header']}' (also called '{row['Business Header']}'): {row['Definition']}. Example: {row['Example']}\n"
+                )
+
+        parts = ["This is the data dictionary. It explains the columns for multiple tables in the database:\n"]
+        for table_name in sorted(tables):
+            parts.append(f"\n--- Table: {table_name} ---\n")
+            parts.extend(tables[table_name])
+
+        return "".join(parts)
        
     except FileNotFoundError:
         return "Data dictionary file not found. I will proceed without it."
     except Exception as e:
         return f"Error reading data dictionary: {e}"
     
-def _parse_llm_json_response(llm_text_response: str) -> Dict:
+# --- Structured Output Tools ---
+# The LLM-backed tools force Anthropic to answer through one of these tool schemas,
+# so the response arrives as an already-parsed dict instead of free text.
+NER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "table": {"type": "string"},
+        "columns_to_select": {"type": "array", "items": {"type": "string"}},
+        "filters": {"type": "object"},
+    },
+    "required": ["table", "columns_to_select", "filters"],
+}
+
+NER_TOOL = {
+    "name": "emit_ner",
+    "description": "Returns the entities extracted from the user's question.",
+    "input_schema": NER_SCHEMA,
+}
+
+SQL_QUERY_TOOL = {
+    "name": "emit_sql_query",
+    "description": "Returns the final SQLite query.",
+    "input_schema": {
+        "type": "object",
+        "properties": {"sql_query": {"type": "string"}},
+        "required": ["sql_query"],
+    },
+}
+
+def _forced_tool_args(tool: Dict) -> Dict:
+    """Returns the messages.create arguments that force the LLM to answer through the given tool."""
+    return {"tools": [tool], "tool_choice": {"type": "tool", "name": tool["name"]}}
+
+def _tool_input(response) -> Dict:
+    """Returns the input of the tool_use block from a forced tool-use response."""
+    return next(block.input for block in response.content if block.type == "tool_use")
+
+def _cached_text_block(text: str) -> Dict:
+    """Wraps static prompt text in a content block marked for Anthropic prompt caching."""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+def _cached_prompt_messages(static_prefix: Dict, dynamic_suffix: str) -> List[Dict]:
     """
-    A robust helper function to extract a JSON object from an LLM text response.
+    Builds the user message for an LLM call from a prebuilt, cached static prefix block
+    (see _cached_text_block) followed by the per-request suffix, so only the suffix is
+    processed again on subsequent calls.
     """
-    try:
-        #find the start and end of the JSON object
-        start_index = llm_text_response.find("{")
-        end_index = llm_text_response.rfind("}") + 1
-        if start_index != -1 and end_index != 0:
-            json_str = llm_text_response[start_index:end_index]
-            # Parse the JSON string to ensure it's valid
-            return json.loads(json_str)
-    except json.JSONDecodeError as e:
-        return {"error": f"JSON decoding error: {e}"}
-    return {"error": "No valid JSON found in the response."}
-
-def get_database_schema(db_path):
-
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    #give a list of all tables in the database
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    table_names = [table[0] for table in tables]
-    str_table_names = ", ".join(table_names)
-    str_table_names = str_table_names.replace(" ", "")
-
-    schema_description = f"Database schema contains the following tables: {str_table_names}. Each table contains various columns with specific data types."
-    for table_name in table_names:
-        # Get the column names and types for each table
-        schema_description += f"\n\nTable: {table_name}\nColumns:\n"
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        for col in columns:
-            column_name = col[1]
-            column_type = col[2]
-            schema_description += f"{column_name} ({column_type})\n"
-    # Close the database connection
-    conn.close()
+    return [
+        {
+            "role": "user",
+            "content": [static_prefix, {"type": "text", "text": dynamic_suffix}],
+        }
+    ]
+
+@functools.lru_cache(maxsize=1)
+def get_database_schema():
+
+    with _DB_LOCK:
+        cursor = _DB_CONN.cursor()
+
+        #give a list of all tables in the database
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        tables = cursor.fetchall()
+        table_names = [table[0] for table in tables]
+        str_table_names = ", ".join(table_names)
+        str_table_names = str_table_names.replace(" ", "")
+
+        schema_description = f"Database schema contains the following tables: {str_table_names}. Each table contains various columns with specific data types."
+        for table_name in table_names:
+            # Get the column names and types for each table
+            schema_description += f"\n\nTable: {table_name}\nColumns:\n"
+            cursor.execute(f"PRAGMA table_info({table_name});")
+            columns = cursor.fetchall()
+            for col in columns:
+                column_name = col[1]
+                column_type = col[2]
+                schema_description += f"{column_name} ({column_type})\n"
+        cursor.close()
     # Return the schema description
     return schema_description
+
+# --- Static Reference Context ---
+# The schema and data dictionary do not change while the server runs, so they are
+# computed once at startup and sent as a cached system prompt on every SQL-related call.
+SCHEMA_STR = get_database_schema()
+DATA_DICT_STR = get_data_dictionary_description()
+REFERENCE_SYSTEM_PROMPT = [
+    _cached_text_block(f"""
+    You are part of a multi-step agent that answers questions about an electric vehicle SQLite database.
+    Use the reference information below whenever a task refers to the Official Database Schema or the Data Dictionary.
+
+    *** Official Database Schema: ***
+    {SCHEMA_STR}
+
+    *** Data Dictionary: *** (for examples of values)
+    {DATA_DICT_STR}
+    """)
+]
+
 # --- Tool 1: NER Generator ---
-@mcp.tool()
-def ner_generator_dynamic(question: str) -> str: #returns a JSON string
-    """
-    Analyzes a question to extract key entities (tables, columns, filters)
-    needed to form a database query. Uses a data dictionary for context.
-    """
-    data_dictionary = get_data_dictionary_description()
-    prompt = f"""
+NER_PROMPT_PREFIX = _cached_text_block("""
     You are a data analyst. Your job is to extract key entities from a user's question.
     Use the provided data dictionary to understand the columns.
     Get the correct table name, columns to select, and any filters needed.
     The data dictionary provides the structure and meaning of the database tables and columns.
     For example, if you thought 'Electric_Range' but the Data Dictionary says 'Electric Range', you must correct it to '"Electric Range"'
     Use the provided data dictionary to understand the columns and tables. ** The user might mention multiple tables (counties). **
+    The Data Dictionary is provided in the system prompt.
 
-
-    Data Dictionary:
-    {data_dictionary}
-
-    User Question: "{question}"
-
-    Extract the necessary components to answer the question. It's okay if the question involves multiple tables. Your output MUST be a single JSON object with keys: "table", "columns_to_select", and "filters".
+    Extract the necessary components to answer the question. It's okay if the question involves multiple tables. Report your output with the emit_ner tool, using the keys "table", "columns_to_select", and "filters".
     - "table": The table name, which is always a county name (e.g., "King").
     - "columns_to_select": A list of columns the user wants to see.
     - "filters": A dictionary of filters to apply, where the key is the column name and value is the condition.
 
+    """)
+
+@mcp.tool()
+async def ner_generator_dynamic(question: str) -> Dict: #returns a dict
+    """
+    Analyzes a question to extract key entities (tables, columns, filters)
+    needed to form a database query. Uses a data dictionary for context.
+    """
+    dynamic_prompt = f"""
+    User Question: "{question}"
     """
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
+        response = await _create_message(
+            model="claude-3-5-haiku-20241022",
             max_tokens=1024,
-            messages=[{"role": "user", "content": prompt}],
+            system=REFERENCE_SYSTEM_PROMPT,
+            messages=_cached_prompt_messages(NER_PROMPT_PREFIX, dynamic_prompt),
+            **_forced_tool_args(NER_TOOL),
         )
-        json_str = response.content[0].text
-        parsed_dict = _parse_llm_json_response(json_str)
-        return json.dumps(parsed_dict)
+        return _tool_input(response)
         
     except Exception as e:
-        return json.dumps({"error": f"Error in ner_generator_dynamic: {e}"})
+        return {"error": f"Error in ner_generator_dynamic: {e}"}
     
 # --- Tool 2: Create SQL ---
-@mcp.tool()
-def create_sql(question: str, ner_dict: Dict) -> str:#returns a JSON string
-    """
-    Creates a full SQLite query by combining the user's question and the
-    extracted entities from the ner_generator_dynamic tool.
-    """
-    ner_json = json.dumps(ner_dict, indent=2)
-    prompt = f"""
+CREATE_SQL_PROMPT_PREFIX = _cached_text_block("""
     You are an expert SQLite developer. Create a single, valid SQLite query to answer the user's question.
     Understand the user's intent and the context provided by the extracted entities.
     The query may be complex, using window functions (like ROW_NUMBER(), PARTITION BY), subqueries, or other advanced features.
 
-    User's Question: "{question}"
-    Extracted Entities: {ner_json}
-
      *** IMPORTANT INSTRUCTIONS FOR MULTI-TABLE QUERIES *** - The user's database has a separate table for each county (e.g., 'King', 'Thurston', 'Clark'). 
      - All these tables have the exact same columns (e.g., "Make", "Base MSRP", etc.). 
      - If the user's question involves comparing or finding data in *multiple* tables (e.g., "in both Thurston and Clark"), you MUST use a JOIN or INTERSECT statement. 
@@ -165,12 +237,25 @@ def create_sql(question: str, ner_dict: Dict) -> str:#returns a JSON string
 
     Your output MUST be the raw SQLite query text, and nothing else. Do not wrap it in JSON or markdown.
 
+    """)
+
+@mcp.tool()
+async def create_sql(question: str, ner_dict: Dict) -> Dict:#returns a dict
+    """
+    Creates a full SQLite query by combining the user's question and the
+    extracted entities from the ner_generator_dynamic tool.
+    """
+    ner_json = orjson.dumps(ner_dict).decode()
+    dynamic_prompt = f"""
+    User's Question: "{question}"
+    Extracted Entities: {ner_json}
     """
     try:
-        response = anthropic_client.messages.create(
+        response = await _create_message(
             model="claude-3-5-sonnet-20241022",
             max_tokens=1024,
-            messages=[{"role": "user", "content": prompt}],
+            system=REFERENCE_SYSTEM_PROMPT,
+            messages=_cached_prompt_messages(CREATE_SQL_PROMPT_PREFIX, dynamic_prompt),
         )
         
         # The raw SQL query is extracted from the response.
@@ -179,34 +264,18 @@ def create_sql(question: str, ner_dict: Dict) -> str:#returns a JSON string
         # We now reliably create the JSON object in Python.
         sql_dict = {"sql_query": raw_sql_query}
         
-        return json.dumps(sql_dict)
+        return sql_dict
     except Exception as e:
-        return json.dumps({"error": f"LLM Error in create_sql: {e}"})
+        return {"error": f"LLM Error in create_sql: {e}"}
 
 
 
 # --- Tool 3 : Validate SQL agent ---    
-@mcp.tool()
-def validator_sql_agent(question: str, ner_dict: Dict, generated_query_dict: Dict) -> str: #return a JSON string
-    """
-    Validates a generated SQL query for correctness, syntax, and hallucinations against the schema.
-    Returns a corrected/validated version as a JSON string.
-    """
-    schema_info = get_database_schema(DB_PATH)
-    generated_query_json = json.dumps(generated_query_dict) #here it converts the dict to a JSON string
-    data_dictionary_info = get_data_dictionary_description()
-    prompt = f"""
+VALIDATOR_PROMPT_PREFIX = _cached_text_block("""
     You are an extreamely meticulous SQL validator and debugger. Your task is to check if the provided SQL query correctly answers the user's question and is syntactically correct for SQLite.
     You MUST Strictly follow the schema information provided to ensure no incorrect column or table names. Pay close attention to space or special characters in names. Column names with spaces must be enclosed in double quotes (e.g., "Electric Range").
     Avoid hallucinations or incorrect names.
-
-    Provided Information:
-    1.  User's Original Question: "{question}"
-    2.  Extracted Entities (for context): {json.dumps(ner_dict, indent=2)}
-    3.  Generated SQL Query to Validate: {generated_query_json}
-    4.  *** Official Database Schema: *** {schema_info}
-    5.  *** Data Dictionary: *** (for examples of values)
-        {data_dictionary_info}
+    The Official Database Schema and the Data Dictionary are provided in the system prompt.
 
     Your Two Mandatory Tasks: 
     1. **Correct Column Names:** First, verify that every single column and table name in the query (in SELECT, WHERE, GROUP BY, etc.) exactly matches a name in the Official Schema. If you see a simplified name like `Make` or `Fuel_Type`, you MUST correct it to the full, quoted name like `"Make"` or `"Electric Vehicle Type"`. 
@@ -222,50 +291,84 @@ def validator_sql_agent(question: str, ner_dict: Dict, generated_query_dict: Dic
 
  
     
-    Your output MUST be a single JSON object with one key: "sql_query", containing the final, validated, and potentially corrected query.
+    Report your output with the emit_sql_query tool; "sql_query" must contain the final, validated, and potentially corrected query.
+    """)
+
+@mcp.tool()
+async def validator_sql_agent(question: str, ner_dict: Dict, generated_query_dict: Dict) -> Dict: #returns a dict
+    """
+    Validates a generated SQL query for correctness, syntax, and hallucinations against the schema.
+    Returns the corrected/validated query as a dict with a "sql_query" key.
+    """
+    generated_query_json = orjson.dumps(generated_query_dict).decode() #here it converts the dict to a JSON string
+    dynamic_prompt = f"""
+    Provided Information:
+    1.  User's Original Question: "{question}"
+    2.  Extracted Entities (for context): {orjson.dumps(ner_dict).decode()}
+    3.  Generated SQL Query to Validate: {generated_query_json}
     """
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022", max_tokens=1024, messages=[{"role": "user", "content": prompt}]
+        response = await _create_message(
+            model="claude-3-5-sonnet-20241022",
+            max_tokens=1024,
+            system=REFERENCE_SYSTEM_PROMPT,
+            messages=_cached_prompt_messages(VALIDATOR_PROMPT_PREFIX, dynamic_prompt),
+            **_forced_tool_args(SQL_QUERY_TOOL),
         )
-        parsed_dict = _parse_llm_json_response(response.content[0].text)
-        return json.dumps(parsed_dict)
+        return _tool_input(response)
     except Exception as e:
-        return json.dumps({"error": f"LLM Error in validator_sql_agent: {e}"})
+        return {"error": f"LLM Error in validator_sql_agent: {e}"}
+
+# _DB_CONN is opened read-only (mode=ro, query_only), so identical queries always return
+# the same rows. Statements that return no rows raise instead, so they are never cached.
+@functools.lru_cache(maxsize=256)
+def _execute_sql_query(sql_query: str) -> str:
+    """
+    Runs a SQL query on the shared connection and returns the rows as a JSON string.
+    Rows are encoded in batches straight from the cursor as lists alongside a single
+    "columns" list, instead of materialising every row and a dict per row first.
+    """
+    buffer = io.BytesIO()
+    with _DB_LOCK:
+        cursor = _DB_CONN.execute(sql_query)
+        if cursor.description is None:
+            cursor.close()
+            raise ValueError("Only queries that return rows (SELECT) can be run.")
+        cursor.arraysize = 1000
+        column_names = [desc[0] for desc in cursor.description]
+
+        buffer.write(b'{"columns":')
+        buffer.write(orjson.dumps(column_names))
+        buffer.write(b',"data":[')
+        separator = b""
+        while rows := cursor.fetchmany():
+            for row in rows:
+                buffer.write(separator)
+                buffer.write(orjson.dumps(row))
+                separator = b","
+        buffer.write(b"]}")
+        cursor.close()
+
+    return buffer.getvalue().decode()
 
 # --- Tool 4: Run SQLite Query---
 @mcp.tool()
-def run_sqlite_query(sql_dict: Dict) -> str:  #returns a JSON string
+async def run_sqlite_query(sql_dict: Dict) -> str:  #returns a JSON string
     """Executes a SQL query and returns the data as a JSON string."""
     try:
-        #json_str = sql_json[sql_json.find('{') : sql_json.rfind('}') + 1]
         sql_query = sql_dict.get("sql_query")
-        # data = json.loads(json_str)
-        # sql_query = data.get("sql_query")
-
-        # if data.get("error"):
-        #     return json.dumps({"error": f"Cannot execute due to previous error: {data['error']}", "data": []})
         if not sql_query:
-            return json.dumps({"error": "No SQL query provided.", "data": []})
+            return orjson.dumps({"error": "No SQL query provided.", "data": []}).decode()
 
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        results = cursor.fetchall()
-        column_names = [desc[0] for desc in cursor.description]
-        conn.close()
-
-        formatted_results = [dict(zip(column_names, row)) for row in results]
-        return json.dumps({"data": formatted_results})
-        # print(f"Query executed successfully. Results: {formatted_results}")
-        # return {"data": formatted_results}
-      
+        # sqlite is blocking, so the query runs on a worker thread to keep the
+        # FastMCP event loop free for concurrent tool calls.
+        return await asyncio.to_thread(_execute_sql_query, sql_query)
     except Exception as e:
-        return json.dumps({"error": f"Database query failed: {e}", "data": []})
+        return orjson.dumps({"error": f"Database query failed: {e}", "data": []}).decode()
 
 # --- Tool 5: Handle Error Agent (NEW) ---
 @mcp.tool()
-def handle_error_agent(failed_sql_query_dict: Dict, error_message: str) -> str: #returns a JSON string
+async def handle_error_agent(failed_sql_query_dict: Dict, error_message: str) -> Dict: #returns a dict
     """
     Attempts to fix a failed SQL query based on the specific error message from the database.
     """
@@ -285,23 +388,25 @@ def handle_error_agent(failed_sql_query_dict: Dict, error_message: str) -> str:
     1.  Carefully analyze the query and the error message.
     2.  Provide a corrected SQLite query that resolves the identified error.
     
-    Your output MUST be a single JSON object with one key: "sql_query", containing only the corrected query.
+    Report your output with the emit_sql_query tool; "sql_query" must contain only the corrected query.
     """
     try:
-        response = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022", max_tokens=1024, messages=[{"role": "user", "content": prompt}]
+        response = await _create_message(
+            model="claude-3-5-haiku-20241022",
+            max_tokens=1024,
+            system=REFERENCE_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": prompt}],
+            **_forced_tool_args(SQL_QUERY_TOOL),
         )
-        parsed_dict = _parse_llm_json_response(response.content[0].text)
-
-        return json.dumps(parsed_dict)
+        return _tool_input(response)
     except Exception as e:
-        return json.dumps({"error": f"LLM Error in handle_error_agent: {e}"})
+        return {"error": f"LLM Error in handle_error_agent: {e}"}
 
 # --- Tool 6: Generate Final Answer ---
 @mcp.tool()
-def generate_final_answer(question: str, query_result_dict: Dict) -> str:
+async def generate_final_answer(question: str, query_result_dict: Dict) -> str:
     """Takes the database results and generates a human-readable answer."""
-    query_result_json = json.dumps(query_result_dict, indent=2) 
+    query_result_json = orjson.dumps(query_result_dict).decode()
 
     prompt = f"""
     You are a helpful assistant. Answer the user's question based on the provided data.
@@ -318,7 +423,7 @@ def generate_final_answer(question: str, query_result_dict: Dict) -> str:
     4. If you don't have enough information to answer, simply say "I'm sorry, I don't have enough information to answer that question"
     """
     try:
-        response = anthropic_client.messages.create(
+        response = await _create_message(
             model="claude-3-sonnet-20240229",
             max_tokens=2048,
             messages=[{"role": "user", "content": prompt}],
@@ -328,6 +433,62 @@ def generate_final_answer(question: str, query_result_dict: Dict) -> str:
     except Exception as e:
         return f"Error formulating final answer: {e}"
 
+# --- Tool 7: Plan and Generate SQL (fused NER + SQL + validation) ---
+SQL_PLAN_TOOL = {
+    "name": "emit_sql_plan",
+    "description": "Returns the extracted entities and the final, validated SQLite query.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "ner": NER_SCHEMA,
+            "sql_query": {"type": "string"},
+        },
+        "required": ["ner", "sql_query"],
+    },
+}
+
+SQL_PLAN_PROMPT_PREFIX = _cached_text_block("""
+    You are an expert data analyst and SQLite developer. Answer the user's question in three steps and report the result with the emit_sql_plan tool.
+
+    1. **Extract entities:** Using the Data Dictionary in the system prompt, identify the table(s), the columns to select, and any filters.
+       - "table": The table name, which is always a county name (e.g., "King"). ** The user might mention multiple tables (counties). **
+       - "columns_to_select": A list of columns the user wants to see.
+       - "filters": A dictionary of filters to apply, where the key is the column name and value is the condition.
+
+    2. **Write the query:** Create a single, valid SQLite query that answers the question. It may use window functions, subqueries, or other advanced features.
+       - The database has a separate table for each county (e.g., 'King', 'Thurston', 'Clark'), all with the exact same columns.
+       - If the question involves *multiple* tables (e.g., "in both Thurston and Clark"), you MUST use a JOIN or INTERSECT statement, usually joining on a common column like "Make" or "VIN (1-10)".
+         Example: SELECT T1."Make" FROM Thurston AS T1 INNER JOIN Clark AS T2 ON T1."Make" = T2."Make";
+
+    3. **Validate the query:** Before reporting it, check the query against the Official Database Schema in the system prompt.
+       - Every column and table name must exactly match the schema. Quote names with spaces (e.g., "Electric Range", "Base MSRP", "VIN (1-10)").
+       - Values compared in the WHERE clause for categorical columns must match the Data Dictionary examples (e.g., 'Battery Electric Vehicle (BEV)', not 'BEV').
+       - The query logic must reflect the question (e.g., "top 3" needs ORDER BY and LIMIT 3).
+    """)
+
+@mcp.tool()
+async def plan_and_generate_sql(question: str) -> Dict: #returns a dict
+    """
+    Preferred first step for answering a question. In a single call, extracts the key
+    entities (tables, columns, filters) from the question and writes a validated SQLite
+    query for them, replacing ner_generator_dynamic, create_sql and validator_sql_agent.
+    Returns {"ner": {...}, "sql_query": "..."}; pass it directly to run_sqlite_query.
+    """
+    dynamic_prompt = f"""
+    User Question: "{question}"
+    """
+    try:
+        response = await _create_message(
+            model="claude-3-5-sonnet-20241022",
+            max_tokens=1024,
+            system=REFERENCE_SYSTEM_PROMPT,
+            messages=_cached_prompt_messages(SQL_PLAN_PROMPT_PREFIX, dynamic_prompt),
+            **_forced_tool_args(SQL_PLAN_TOOL),
+        )
+        return _tool_input(response)
+    except Exception as e:
+        return {"error": f"LLM Error in plan_and_generate_sql: {e}"}
+
 # --- Run Server ---
 if __name__ == "__main__":
     print("MCP server with multi-step AI pipeline is starting...")
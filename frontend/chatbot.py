@@ -1,91 +1,301 @@
 import streamlit as st
 import httpx
-from typing import Dict, Any
+import asyncio
+import orjson
+import atexit
+import re
+import string
+import threading
+from types import MappingProxyType
+from typing import Dict, Any, AsyncIterator, Final, List, Optional, Tuple
+
+@st.cache_resource
+def get_http_client(api_url: str) -> Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]:
+    """
+    Returns the long-lived, pooled HTTP client for the backend and the event loop that owns it.
+    st.cache_resource keeps a single instance across reruns and sessions. Every rerun runs
+    in a fresh asyncio.run() loop, and pooled connections cannot outlive the loop they were
+    opened on, so the client lives on its own background loop.
+    """
+    # The client is built first so that, if it fails, no loop or thread is left running
+    # (st.cache_resource does not cache exceptions, so the next call would start another)
+    client = httpx.AsyncClient(
+        base_url=api_url,
+        # Keep idle connections for 75s so they survive the user's think-time between questions
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=75.0),
+        timeout=httpx.Timeout(300.0, connect=10.0),
+    )
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="http-client-loop", daemon=True).start()
+    atexit.register(_close_http_client, loop, client)
+    # Open the first pooled connection now so the user's first query skips the handshake
+    asyncio.run_coroutine_threadsafe(_prewarm_http_client(client), loop)
+    return loop, client
+
+async def _prewarm_http_client(client: httpx.AsyncClient):
+    """Sends a HEAD /health request to establish a keep-alive connection to the backend."""
+    try:
+        await client.head("/health")
+    except httpx.HTTPError as e:
+        print(f"Could not pre-warm the backend connection: {e}")
+
+def _close_http_client(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient):
+    """Closes the pooled HTTP client and stops its event loop on interpreter exit."""
+    asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+    loop.call_soon_threadsafe(loop.stop)
+
+# Number of most recent questions (each with its answer and agent steps) rendered per rerun,
+# and how many more "Load earlier messages" adds
+HISTORY_PAGE_SIZE = 10
+
+# The non-empty text blocks and the tool_use blocks of an assistant message
+MessageBlocks = Tuple[List[Dict], List[Dict]]
+
+def classify_message(message: Dict) -> Optional[MessageBlocks]:
+    """Splits an assistant message's content into its blocks to render; None for other messages."""
+    content = message.get("content")
+    if message.get("role") != "assistant" or not isinstance(content, list):
+        return None
+    text_blocks, tool_blocks = [], []
+    for block in content:
+        block_type = block.get("type")
+        if block_type == "tool_use":
+            tool_blocks.append(block)
+        elif block_type == "text" and block.get("text"):
+            text_blocks.append(block)
+    return text_blocks, tool_blocks
+
+# Fenced code blocks (an unclosed fence runs to the end of the text) and single-line code spans
+# that do not start at a backslash-escaped backtick
+_FENCED_CODE_RE = re.compile(
+    r"^ {0,3}(`{3,}|~{3,})[^\n]*(.*?)(?:^ {0,3}\1[`~]*[ \t]*$|\Z)", re.MULTILINE | re.DOTALL
+)
+_INLINE_CODE_RE = re.compile(r"(?<![\\`])(`+)(?!`)([^\n]+?)(?<!`)\1(?!`)")
+# Code is emitted as HTML, so every punctuation character becomes a character reference that
+# the browser shows as-is and Markdown cannot treat as syntax
+_CODE_ESCAPES = str.maketrans({c: f"&#{ord(c)};" for c in string.punctuation})
+
+def _escape_text(text: str) -> str:
+    """Escapes "&" and "<" in Markdown text and turns its code spans into <code> elements."""
+    parts, end = [], 0
+    for match in _INLINE_CODE_RE.finditer(text):
+        parts.append(text[end:match.start()].replace("&", "&amp;").replace("<", "&lt;"))
+        parts.append(f"<code>{match.group(2).translate(_CODE_ESCAPES)}</code>")
+        end = match.end()
+    parts.append(text[end:].replace("&", "&amp;").replace("<", "&lt;"))
+    return "".join(parts)
+
+def escape_markdown_html(text: str) -> str:
+    r"""
+    Escapes Markdown text for rendering with unsafe_allow_html, so it cannot contain raw HTML.
+    Every "<" is escaped; code is rendered as <code>/<pre> elements with its characters
+    escaped as references, which (unlike in Markdown code) the browser shows as written.
+
+    >>> escape_markdown_html("<b>x</b> &lt; `a < b`")
+    '&lt;b>x&lt;/b> &amp;lt; <code>a &#60; b</code>'
+    >>> escape_markdown_html("```sql\nSELECT 1 WHERE a < b\n```")
+    '<pre><code>SELECT 1 WHERE a &#60; b</code></pre>'
+    >>> escape_markdown_html("a `b\n\n</div><script>x</script>\n\n` c")
+    'a `b\n\n&lt;/div>&lt;script>x&lt;/script>\n\n` c'
+    >>> escape_markdown_html("\\`<b>x</b>\\`")
+    '\\`&lt;b>x&lt;/b>\\`'
+    """
+    parts, end = [], 0
+    for match in _FENCED_CODE_RE.finditer(text):
+        parts.append(_escape_text(text[end:match.start()]))
+        code = match.group(2)[1:]
+        if code.endswith("\n"):
+            code = code[:-1]
+        parts.append(f"<pre><code>{code.translate(_CODE_ESCAPES)}</code></pre>")
+        end = match.end()
+    parts.append(_escape_text(text[end:]))
+    return "".join(parts)
+
+def render_chat_html(message: Dict, blocks: Optional[MessageBlocks]) -> str:
+    """
+    Renders a message's part of the chat transcript as an HTML fragment; empty if it has none.
+    Text is escaped so it cannot inject markup, while the blank lines keep Markdown working.
+    """
+    content = message.get("content")
+    if message.get("role") == "user" and isinstance(content, str):
+        return f'<div class="chat-msg chat-user">\n\n{escape_markdown_html(content)}\n\n</div>\n\n'
+    if blocks is None:
+        return ""
+    final_text_blocks, tool_use_blocks = blocks
+    # Assistant turns that call tools only show up in the "Agent Steps" panel
+    if tool_use_blocks or not final_text_blocks:
+        return ""
+    text = "\n\n".join(escape_markdown_html(block["text"]) for block in final_text_blocks)
+    return f'<div class="chat-msg chat-assistant">\n\n{text}\n\n</div>\n\n'
+
+def _init_state():
+    """Initialises the per-session state on the first run; later reruns only check the sentinel."""
+    ss = st.session_state
+    if ss.setdefault("_initialized", False):
+        return
+    ss.setdefault("messages", [])
+    ss.setdefault("message_blocks", [])
+    ss.setdefault("chat_html", [])
+    ss.setdefault("visible_turns", HISTORY_PAGE_SIZE)
+    ss._initialized = True
+
+# Page title and chat transcript styling. Streamlit drops any element a rerun does not emit again,
+# so this is rendered on every run, but the markup itself is built once.
+TITLE_HTML = """
+    <style>
+    .title-container { background-color: #f0f2f6; padding: 1rem; border-radius: 0.5rem; text-align: center; margin-bottom: 2rem; }
+    .title-container h1 { color: #262730; margin: 0; }
+    .chat-msg { padding: 0.5rem 1rem; border-radius: 0.5rem; margin-bottom: 0.75rem; }
+    .chat-user { background-color: #f0f2f6; margin-left: 20%; }
+    .chat-assistant { border: 1px solid #e6e9ef; margin-right: 20%; }
+    </style>
+    <div class="title-container"><h1>MCP SQL Agent 🤖</h1></div>
+"""
+
+# Built once per process and shared read-only by every Chatbot
+TOOL_FRIENDLY_NAMES: Final = MappingProxyType({
+    "plan_and_generate_sql": "SQL Planner Agent",
+    "ner_generator_dynamic": "NER Generator Agent",
+    "create_sql": "SQL Creation Agent",
+    "validator_sql_agent": "SQL Validator Agent",
+    "run_sqlite_query": "Database Query Agent",
+    "handle_error_agent": "Error Handler Agent",
+    "generate_final_answer": "Final Answer Agent"
+})
+
+AGENT_EXPLANATIONS: Final = MappingProxyType({
+    "SQL Planner Agent": "Extracts the key entities and writes a validated SQL query in a single step.",
+    "NER Generator Agent": "Analyzes the user's question to identify key entities like tables and columns.",
+    "SQL Creation Agent": "Writes a complex SQL query based on the user's question and the extracted entities.",
+    "SQL Validator Agent": "Checks the generated SQL for errors, correcting table/column names against the database schema.",
+    "Database Query Agent": "Executes the final, validated SQL query against the database to fetch the data.",
+    "Error Handler Agent": "If a query fails, this agent attempts to fix it based on the database error message.",
+    "Final Answer Agent": "Formats the data returned from the database into a human-readable final answer."
+})
 
 class Chatbot:
     def __init__(self, api_url: str):
+        # The instance is shared across reruns and sessions (see get_chatbot in main.py),
+        # so per-session state is initialised in render instead of here.
         self.api_url = api_url
-        if "messages" not in st.session_state:
-            st.session_state.messages = []
-        # Flag to track if the backend needs to be called
-        if "run_backend" not in st.session_state:
-            st.session_state.run_backend = False
-
-        self.tool_friendly_names = {
-            "ner_generator_dynamic": "NER Generator Agent",
-            "create_sql": "SQL Creation Agent",
-            "validator_sql_agent": "SQL Validator Agent",
-            "run_sqlite_query": "Database Query Agent",
-            "handle_error_agent": "Error Handler Agent",
-            "generate_final_answer": "Final Answer Agent"
-        }
-        
-        self.agent_explanations = {
-            "NER Generator Agent": "Analyzes the user's question to identify key entities like tables and columns.",
-            "SQL Creation Agent": "Writes a complex SQL query based on the user's question and the extracted entities.",
-            "SQL Validator Agent": "Checks the generated SQL for errors, correcting table/column names against the database schema.",
-            "Database Query Agent": "Executes the final, validated SQL query against the database to fetch the data.",
-            "Error Handler Agent": "If a query fails, this agent attempts to fix it based on the database error message.",
-            "Final Answer Agent": "Formats the data returned from the database into a human-readable final answer."
-        }
+        # Create the pooled client (which pre-warms its first connection) on page load
+        # rather than when the first question is submitted
+        get_http_client(api_url)
     
     @st.dialog("About The Agents")
     def show_agent_explanations_dialog(self):
         """Creates the content that will be shown inside the pop-up dialog."""
-        for agent_name, description in self.agent_explanations.items():
+        for agent_name, description in AGENT_EXPLANATIONS.items():
             st.markdown(f"**{agent_name}:** {description}")
 
     def display_history(self, chat_container, tool_container):
-        """Displays the entire message history from the session state."""
-        for message in st.session_state.messages:
-            self.display_message(message, chat_container, tool_container)
+        """Displays the most recent questions and answers from the session state, with their agent steps."""
+        messages = st.session_state.messages
+        # Classified blocks and chat HTML are cached per message in lists aligned with the history.
+        # Stored messages are never edited, only appended or truncated (on a failed query, before
+        # they reach these caches), so only messages added since the last rerun are processed.
+        message_blocks = st.session_state.message_blocks
+        chat_html = st.session_state.chat_html
+        del message_blocks[len(messages):]
+        del chat_html[len(messages):]
+        for message in messages[len(message_blocks):]:
+            blocks = classify_message(message)
+            message_blocks.append(blocks)
+            chat_html.append(render_chat_html(message, blocks))
+
+        # Only the most recent turns are rendered; older ones are paged in on request. A turn
+        # starts at the user's question and also holds the tool calls and results after it.
+        visible_turns = st.session_state.visible_turns
+        start, turns = len(messages), 0
+        while start and turns < visible_turns:
+            start -= 1
+            message = messages[start]
+            turns += message.get("role") == "user" and isinstance(message.get("content"), str)
+        with chat_container:
+            if start:
+                st.button("Load earlier messages", on_click=self.load_earlier_messages)
+            # The whole transcript is a single element, so its cost does not grow with the
+            # number of widgets on the page
+            if transcript := "".join(chat_html[start:]):
+                st.markdown(transcript, unsafe_allow_html=True)
+
+        for blocks in message_blocks[start:]:
+            self.display_tool_steps(blocks, tool_container)
+
+    def load_earlier_messages(self):
+        """Shows another page of older messages on the next rerun."""
+        st.session_state.visible_turns += HISTORY_PAGE_SIZE
 
     def display_message(self, message: Dict, chat_container, tool_container):
-        """Displays a single message in the correct column with the correct alignment."""
-        role = message.get("role")
-        content = message.get("content")
+        """Displays a single new message in the chat transcript or the agent steps panel."""
+        blocks = classify_message(message)
+        if fragment := render_chat_html(message, blocks):
+            chat_container.markdown(fragment, unsafe_allow_html=True)
+        self.display_tool_steps(blocks, tool_container)
 
-        with chat_container:
-            if role == "user" and isinstance(content, str):
-                _, col2 = st.columns([1, 4])
-                with col2:
-                    with st.chat_message("user"):
-                        st.markdown(content)
-
-            elif role == "assistant" and isinstance(content, list):
-                # This logic is for the right-hand "Agent Steps" panel
-                has_tool_calls = any(block.get("type") == "tool_use" for block in content)
-                tool_use_blocks = [block for block in content if block.get("type") == "tool_use"]
-                
-                if tool_use_blocks:
-                    with tool_container:
-                        for block in tool_use_blocks:
-                            technical_name = block.get('name', 'unknown_tool')
-                            friendly_name = self.tool_friendly_names.get(technical_name, technical_name)
-                            st.info(f"**Tool Used:** {friendly_name}")
-                            st.json(block.get('input', {}), expanded=False)
-                
-                # This logic is for the left-hand "Chat Conversation" panel
-                if not has_tool_calls:
-                    final_text_blocks = [block for block in content if block.get("type") == "text" and block.get("text")]
-                    if final_text_blocks:
-                        col1, _ = st.columns([4, 1])
-                        with col1:
-                            with st.chat_message("assistant"):
-                                for block in final_text_blocks:
-                                    st.markdown(block.get("text"))
+    def display_tool_steps(self, blocks: Optional[MessageBlocks], tool_container):
+        """Lists the tools an assistant message called in the right-hand "Agent Steps" panel."""
+        if not blocks or not blocks[1]:
+            return
+        get_name = TOOL_FRIENDLY_NAMES.get
+        with tool_container:
+            for block in blocks[1]:
+                technical_name = block.get('name', 'unknown_tool')
+                friendly_name = get_name(technical_name, technical_name)
+                st.info(f"**Tool Used:** {friendly_name}")
+                # The input is only serialized and sent to the browser while its toggle is on.
+                # An expander's open state is not visible to the script, so a keyed toggle is used.
+                if st.toggle("Show input", key=f"tool_input_{block.get('id')}"):
+                    st.code(orjson.dumps(block.get('input', {}), option=orjson.OPT_INDENT_2).decode(), language="json")
+
+    async def stream_lines(self, path: str, **kwargs) -> AsyncIterator[str]:
+        """
+        Sends a POST request to the backend through the shared, pooled HTTP client and
+        yields the non-empty lines of the response body as they arrive.
+        """
+        loop, client = get_http_client(self.api_url)
+        caller_loop = asyncio.get_running_loop()
+        lines: asyncio.Queue = asyncio.Queue()
+
+        async def pump():
+            # Runs on the client's loop and hands each line (or the error) back to this rerun's loop
+            try:
+                async with client.stream("POST", path, **kwargs) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if line:
+                            caller_loop.call_soon_threadsafe(lines.put_nowait, line)
+            except Exception as e:
+                caller_loop.call_soon_threadsafe(lines.put_nowait, e)
+            finally:
+                caller_loop.call_soon_threadsafe(lines.put_nowait, None)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), loop)
+        try:
+            while (line := await lines.get()) is not None:
+                if isinstance(line, Exception):
+                    raise line
+                yield line
+        finally:
+            future.cancel()
+
+    @st.fragment
+    def render_agent_steps_header(self):
+        """
+        Renders the "Agent's Internal Steps" header and its "About Agents" button as a fragment,
+        so opening the dialog reruns only this fragment instead of replaying the chat history.
+        """
+        header_col, button_col = st.columns([0.7, 0.3])
+        with header_col:
+            st.header("Agent's Internal Steps")
+        with button_col:
+            st.button("About Agents", on_click=self.show_agent_explanations_dialog)
 
     async def render(self):
         """Sets up the UI and handles the main application logic."""
-        st.set_page_config(layout="wide", page_title="MCP SQL Agent")
+        _init_state()
 
-        st.markdown("""
-            <style>
-            .title-container { background-color: #f0f2f6; padding: 1rem; border-radius: 0.5rem; text-align: center; margin-bottom: 2rem; }
-            .title-container h1 { color: #262730; margin: 0; }
-            </style>
-            <div class="title-container"><h1>MCP SQL Agent 🤖</h1></div>
-        """, unsafe_allow_html=True)
+        st.markdown(TITLE_HTML, unsafe_allow_html=True)
 
         left_col, right_col = st.columns([2, 1])
 
@@ -94,49 +304,42 @@ class Chatbot:
             chat_container = st.container(height=600, border=True)
             
         with right_col:
-            header_col, button_col = st.columns([0.7, 0.3])
-            with header_col:
-                st.header("Agent's Internal Steps")
-            with button_col:
-                st.button("About Agents", on_click=self.show_agent_explanations_dialog)
-            
+            self.render_agent_steps_header()
             tool_container = st.container(height=600, border=True)
 
         if 'show_info' in st.session_state and st.session_state.show_info:
             self.show_agent_explanations_dialog()
 
-        # Always display the full, persistent history
+        # Display the most recent part of the persistent history
         self.display_history(chat_container, tool_container)
         
-        # Handle user input
+        # Handle user input: show the question right away and call the backend in the same run
         if query := st.chat_input("Ask a question about the vehicle data..."):
-            st.session_state.messages.append({"role": "user", "content": query})
-            st.session_state.run_backend = True
-            st.rerun()
-
-        # Call the backend if the flag is set
-        if st.session_state.get('run_backend', False):
-            st.session_state.run_backend = False
-            query = st.session_state.messages[-1]['content']
+            user_message = {"role": "user", "content": query}
+            st.session_state.messages.append(user_message)
+            self.display_message(user_message, chat_container, tool_container)
+
             with st.spinner("Agent is thinking..."):
+                history_start = len(st.session_state.messages) - 1
                 try:
-                    async with httpx.AsyncClient(timeout=300.0) as client:
-                        response = await client.post(f"{self.api_url}/query", json={"query": query})
-                        response.raise_for_status()
-                        data = response.json()
-                        
-                        # --- THE FIX: Append new messages instead of overwriting history ---
-                        # The backend returns a history for the current query, starting with the user's question.
-                        # We get only the new messages from the assistant by slicing the list.
-                        new_assistant_messages = data["messages"][1:]
-                        
-                        # Add these new messages to our persistent conversation history
-                        st.session_state.messages.extend(new_assistant_messages)
-                        
-                        # Rerun to display the updated, full history
-                        st.rerun()
+                    # The backend streams one message per line, starting with the user's question,
+                    # so each agent step is shown as soon as it is produced.
+                    async for line in self.stream_lines(
+                        "/query/stream",
+                        content=orjson.dumps({"query": query}),
+                        headers={"content-type": "application/json"},
+                    ):
+                        message = orjson.loads(line)
+                        if "error" in message:
+                            raise RuntimeError(message["error"])
+                        if message.get("role") == "user" and isinstance(message.get("content"), str):
+                            continue
+
+                        # Append new messages to the persistent conversation history and paint them in place
+                        st.session_state.messages.append(message)
+                        self.display_message(message, chat_container, tool_container)
 
                 except Exception as e:
                     st.error(f"An error occurred: {str(e)}")
-                    # On error, we remove the user's last question to prevent a broken state
-                    st.session_state.messages.pop()
\ No newline at end of file
+                    # On error, we remove the user's last question and any partial answer to prevent a broken state
+                    del st.session_state.messages[history_start:]
@@ -1,10 +1,20 @@
 import asyncio
+import streamlit as st
 from chatbot import Chatbot
 
+# Page config must be the first Streamlit command of the script, so it is set at the
+# top of the script rather than inside Chatbot.render.
+st.set_page_config(layout="wide", page_title="MCP SQL Agent")
+
+@st.cache_resource
+def get_chatbot(api_url: str) -> Chatbot:
+    """Creates the chatbot once and reuses it across reruns and sessions."""
+    return Chatbot(api_url)
+
 async def run_app():
     """Initializes and renders the chatbot application."""
     api_url = "http://localhost:8000"
-    chatbot = Chatbot(api_url)
+    chatbot = get_chatbot(api_url)
     await chatbot.render()
 
 if __name__ == "__main__":